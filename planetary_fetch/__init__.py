@@ -36,13 +36,19 @@ from .custom_logging import UtilsLogs
 logging.getLogger(__name__).addHandler(NullHandler())
 
 UtilsLogs.add_logging_level("TRACE", 15)
-try:
-    PATH_TO_CONF = os.path.dirname(os.path.realpath(__file__))
-    logging.config.fileConfig(
-        os.path.join(PATH_TO_CONF, "logging.conf"),
-        disable_existing_loggers=False,
-    )
-    logging.debug(f"file {os.path.join(PATH_TO_CONF, 'logging.conf')} loaded")
-except Exception as exception:  # pylint: disable=broad-except
-    logging.warning(f"cannot load logging.conf : {exception}")
+# The flag is stored in the logging module so that it survives a reload of
+# the package: logging.conf is parsed only once per process
+if not getattr(logging, "_planetary_fetch_configured", False):
+    try:
+        PATH_TO_CONF = os.path.dirname(os.path.realpath(__file__))
+        logging.config.fileConfig(
+            os.path.join(PATH_TO_CONF, "logging.conf"),
+            disable_existing_loggers=False,
+        )
+        logging.debug(
+            f"file {os.path.join(PATH_TO_CONF, 'logging.conf')} loaded"
+        )
+        setattr(logging, "_planetary_fetch_configured", True)
+    except Exception as exception:  # pylint: disable=broad-except
+        logging.warning(f"cannot load logging.conf : {exception}")
 logging.setLogRecordFactory(LogRecord)  # pylint: disable=no-member
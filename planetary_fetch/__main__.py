@@ -22,6 +22,7 @@ import logging
 import signal
 import sys
 
+from .concurrency import default_max_workers
 from .planetary_fetch import PlanetaryFetchLib
 from planetary_fetch import __author__
 from planetary_fetch import __copyright__
@@ -97,9 +98,9 @@ def parse_cli() -> argparse.Namespace:
 
     parser.add_argument(
         "--max_workers",
-        default=3,
+        default=default_max_workers(),
         type=int,
-        help="Max workers to download data (default: %(default)s)",
+        help="Max workers to download data, between 1 and 64, or -1 to tune it from the throughput. At most 16 workers download from the same server (default: %(default)s)",
     )
 
     parser.add_argument(
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+# Planetary Fetch - The aim of Planetary Fetch is to dowload data from PDS based on a part of the PDS ID.
+# Copyright (C) 2023 - CNES (Jean-Christophe Malapert for Pôle Surfaces Planétaires)
+#
+# This file is part of Planetary Fetch.
+#
+# Planetary Fetch is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Planetary Fetch is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Planetary Fetch.  If not, see <https://www.gnu.org/licenses/>.
+"""Module for sizing the number of concurrent downloads."""
+import logging
+import os
+import threading
+import time
+from typing import Callable
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# max_workers value asking to tune the number of concurrent downloads from
+# the observed throughput, between 1 and AUTO_MAX_WORKERS_CEILING
+AUTO_MAX_WORKERS = -1
+AUTO_MAX_WORKERS_CEILING = 32
+
+# Number of completed downloads between two adjustments of the concurrency
+AUTO_MAX_WORKERS_WINDOW = 8
+
+# Size in bytes under which a download is not used to tune the concurrency:
+# the small labels are bound by the latency, not by the bandwidth
+AUTO_MAX_WORKERS_MIN_SIZE = 1 << 20
+
+
+def default_max_workers() -> int:
+    """Default number of download workers, the one of ThreadPoolExecutor.
+
+    Returns:
+        int: the number of workers
+    """
+    return min(32, (os.cpu_count() or 1) + 4)
+
+
+def worker_threads(max_workers: int) -> int:
+    """Number of threads needed for a max_workers setting.
+
+    Args:
+        max_workers (int): The maximum number of worker threads or AUTO_MAX_WORKERS.
+
+    Returns:
+        int: the number of threads
+    """
+    if max_workers == AUTO_MAX_WORKERS:
+        return AUTO_MAX_WORKERS_CEILING
+    return max_workers
+
+
+class AdaptiveLimiter:  # pylint: disable=too-many-instance-attributes
+    """Limits the number of concurrent downloads, the limit being tuned by
+    hill climbing on the observed throughput.
+
+    Every `window` completed downloads, the throughput of the window is
+    compared to the previous one: the limit keeps moving by `step` in the
+    same direction while the throughput improves, otherwise the direction is
+    reversed. The downloads smaller than `min_size` are not counted: the
+    throughput of the small labels is bound by the latency, not by the
+    bandwidth.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        initial: int,
+        maximum: int,
+        window: int = AUTO_MAX_WORKERS_WINDOW,
+        step: int = 2,
+        *,
+        clock: Callable[[], float] = time.monotonic,
+        min_size: int = AUTO_MAX_WORKERS_MIN_SIZE,
+    ):
+        """Initialize the limiter.
+
+        Args:
+            initial (int): initial number of concurrent downloads
+            maximum (int): maximum number of concurrent downloads
+            window (int): number of downloads between two adjustments
+            step (int): change of the limit at each adjustment
+            clock (Callable[[], float]): clock in seconds
+            min_size (int): size in bytes under which a download is ignored
+        """
+        self.__condition = threading.Condition()
+        self.__limit = max(1, min(initial, maximum))
+        self.__maximum = maximum
+        self.__min_size = min_size
+        self.__window = window
+        self.__step = step
+        self.__clock = clock
+        self.__active = 0
+        self.__window_bytes = 0
+        self.__window_count = 0
+        self.__window_start = clock()
+        self.__last_throughput: Optional[float] = None
+
+    @property
+    def limit(self) -> int:
+        """The current number of concurrent downloads allowed.
+
+        Returns:
+            int: the limit
+        """
+        return self.__limit
+
+    def __enter__(self):
+        with self.__condition:
+            while self.__active >= self.__limit:
+                self.__condition.wait()
+            self.__active += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self.__condition:
+            self.__active -= 1
+            self.__condition.notify()
+
+    def record(self, size: int):
+        """Record a completed download and adjust the limit every window.
+
+        Args:
+            size (int): number of bytes downloaded
+        """
+        if size < self.__min_size:
+            return
+        with self.__condition:
+            self.__window_bytes += size
+            self.__window_count += 1
+            if self.__window_count < self.__window:
+                return
+            now = self.__clock()
+            elapsed = max(now - self.__window_start, 1e-6)
+            throughput = self.__window_bytes / elapsed
+            if (
+                self.__last_throughput is not None
+                and throughput < self.__last_throughput
+            ):
+                self.__step = -self.__step
+            self.__limit = max(
+                1, min(self.__maximum, self.__limit + self.__step)
+            )
+            logger.debug(
+                f"\t{throughput / 1e6:.1f} MB/s, {self.__limit} concurrent download(s)"
+            )
+            self.__last_throughput = throughput
+            self.__window_bytes = 0
+            self.__window_count = 0
+            self.__window_start = now
+            self.__condition.notify_all()
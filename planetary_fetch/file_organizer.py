@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# Planetary Fetch - The aim of Planetary Fetch is to dowload data from PDS based on a part of the PDS ID.
+# Copyright (C) 2023 - CNES (Jean-Christophe Malapert for Pôle Surfaces Planétaires)
+#
+# This file is part of Planetary Fetch.
+#
+# Planetary Fetch is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Planetary Fetch is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Planetary Fetch.  If not, see <https://www.gnu.org/licenses/>.
+"""Module for organizing the downloaded files in directories."""
+import logging
+import os
+import re
+from typing import Dict
+from typing import Tuple
+
+logger = logging.getLogger(__name__)
+
+# Equivalent of the "*_if*_trr3.*" and "*_de*_ddr1.*" glob patterns, compiled
+# once instead of at each fnmatch call
+_IF_TRR3_PATTERN = re.compile(r"_if.*_trr3\.")
+_DE_DDR1_PATTERN = re.compile(r"_de.*_ddr1\.")
+
+# Observation types handled by FileOrganizer, by filename prefix
+_OBS_TYPES = {"frt": "frt", "hrl": "hrl", "hrs": "hrs"}
+
+
+class FileOrganizer:
+    """
+    A class used to organize downloaded files into a directory structure based on file types.
+
+    Parameters
+    ----------
+    output_dir : str
+        The path to the directory where downloaded files should be stored.
+
+    Methods
+    -------
+    destdir_for(filename)
+        Returns the subdirectory where the file should be stored based on its name.
+    organize(filename)
+        Creates and returns the subdirectory where the file should be stored based on its name.
+    """
+
+    def __init__(self, base_directory: str):
+        """Initialize the FileOrganizer.
+
+        Args:
+            base_directory (str): str
+        """
+        self.base_directory = base_directory
+        # directories already computed, by the part of the filename they
+        # depend on
+        self.__directories: Dict[Tuple[str, str, bool, bool], str] = dict()
+
+    def _build_directory_path(self, obs_type: str, filename: str) -> str:
+        """Define the directory based on the observation type and the filename
+
+        Args:
+            obs_type (str): observation type (frt, hrl or hrs)
+            filename (str): name of the file to store
+
+        Raises:
+            NotImplementedError: Not implemented use case
+
+        Returns:
+            str: the directory
+        """
+        filename_lower = filename.lower()
+        # the observation ID starts after the prefix and its leading zeros
+        if filename_lower.startswith(f"{obs_type}0000"):
+            offset = 7
+        elif filename_lower.startswith(f"{obs_type}000"):
+            offset = 6
+        else:
+            raise NotImplementedError(
+                f"{filename} does not match any case for storage"
+            )
+
+        if _IF_TRR3_PATTERN.search(filename_lower):
+            storage = "DATA"
+        elif _DE_DDR1_PATTERN.search(filename_lower):
+            storage = "DDR"
+        else:
+            raise NotImplementedError(
+                f"{filename} does not match any case for storage"
+            )
+
+        stem_upper = os.path.splitext(filename)[0].upper()
+        obs_type_upper = obs_type.upper()
+        directory_path = os.path.join(
+            self.base_directory,
+            obs_type_upper + stem_upper[offset:9],
+            obs_type_upper + stem_upper[offset:11],
+            storage,
+        )
+
+        logger.debug(f"\t {filename} -> {directory_path}")
+        return directory_path
+
+    def destdir_for(self, filename: str) -> str:
+        """Return the path to the subdirectory where the file should be saved based on its name.
+
+        The organizer holds no state about the file, so that the same
+        instance can be shared by the download workers. The directory only
+        depends on the observation type, the first characters of the
+        filename and its storage case, so it is cached by these keys.
+
+        Args:
+            filename (str): name of the file to store
+
+        Raises:
+            NotImplementedError: Not implemented use case
+
+        Returns:
+            str: The path to the subdirectory where the file should be saved.
+        """
+        filename_lower = filename.lower()
+        obs_type = _OBS_TYPES.get(filename_lower[:3])
+        if obs_type is None:
+            raise NotImplementedError("Only FRT, HRL and HRS are implemented")
+        key = (
+            obs_type,
+            os.path.splitext(filename_lower)[0][:11],
+            _IF_TRR3_PATTERN.search(filename_lower) is not None,
+            _DE_DDR1_PATTERN.search(filename_lower) is not None,
+        )
+        directory = self.__directories.get(key)
+        if directory is None:
+            directory = self._build_directory_path(obs_type, filename)
+            self.__directories[key] = directory
+        return directory
+
+    def organize(self, filename: str) -> str:
+        """Create and return the path to the subdirectory where the file should be saved based on its name.
+
+        Args:
+            filename (str): name of the file to store
+
+        Raises:
+            NotImplementedError: Not implemented use case
+
+        Returns:
+            str: The path to the subdirectory where the file should be saved.
+        """
+        directory: str = self.destdir_for(filename)
+
+        # Create the directory if it doesn't exist
+        os.makedirs(directory, exist_ok=True)
+
+        return directory
@@ -28,23 +28,124 @@ Classes:
     PdsRequest: A class for making requests to the PDS API.
     Files: Downloads files from a list of URLs and saves them to a specified directory.
 """
-import fnmatch
 import json
 import logging
 import os
+import threading
+import warnings
+from collections import defaultdict
+from concurrent.futures import as_completed
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from contextlib import nullcontext
+from itertools import zip_longest
 from string import Template
+from typing import BinaryIO
+from typing import ContextManager
 from typing import Dict
 from typing import List
+from typing import Optional
+from urllib.parse import urlsplit
 
 import requests
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
+from urllib3.util.retry import Retry
+
+# optional, installed with the "orjson" extra, the json module being used
+# otherwise
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # type: ignore
 
 from ._version import __name_soft__
+from .concurrency import AdaptiveLimiter
+from .concurrency import AUTO_MAX_WORKERS
+from .concurrency import AUTO_MAX_WORKERS_CEILING
+from .concurrency import default_max_workers
+from .concurrency import worker_threads
+from .file_organizer import FileOrganizer
 
 
 logger = logging.getLogger(__name__)
 
+# Size in bytes of the chunks streamed from the server to the disk
+CHUNK_SIZE = 1 << 20
+
+# (connect, read) timeouts in seconds when querying the PDS API
+QUERY_TIMEOUT = (5, 120)
+
+# (connect, read) timeouts in seconds when downloading a file
+DOWNLOAD_TIMEOUT = (5, 300)
+
+# Upper bound of the download workers, above it the remote servers throttle
+MAX_WORKERS_LIMIT = 64
+
+# Number of bytes written to a file between two flushes to the disk
+SYNC_SIZE = 8 << 20
+
+# Suffix of the files being downloaded
+PART_SUFFIX = ".part"
+
+# Headers of the requests sent to download a file: the content is not
+# compressed, so that the sizes and the ranges are counted in bytes on disk
+DOWNLOAD_HEADERS = {"Accept-Encoding": "identity"}
+
+# Maximum number of concurrent requests sent to the same server
+MAX_CONNECTIONS_PER_HOST = 16
+
+# Server of the ODE REST API, queried for the metadata
+ODE_URL = "https://oderest.rsl.wustl.edu"
+
+# Number of connections kept alive with the ODE REST API
+ODE_POOL_SIZE = 2
+
+# Logging levels by name, TRACE being the custom level registered by the
+# package __init__
+_LEVELS = {
+    name: logging.getLevelName(name)
+    for name in ("INFO", "DEBUG", "WARNING", "ERROR", "CRITICAL", "TRACE")
+}
+
+
+def create_session(max_workers: int) -> requests.Session:
+    """Create a HTTP session whose connection pool is shared by the workers.
+
+    Keep-alive connections are reused from one request to another, so the
+    TCP and TLS handshakes are only paid once per worker.
+
+    Args:
+        max_workers (int): The maximum number of worker threads or AUTO_MAX_WORKERS.
+
+    Returns:
+        requests.Session: the HTTP session
+    """
+    threads = worker_threads(max_workers)
+    adapter = HTTPAdapter(
+        pool_connections=threads,
+        pool_maxsize=threads * 2,
+        max_retries=Retry(
+            total=5,
+            backoff_factor=0.3,
+            status_forcelist=[429, 500, 502, 503, 504],
+        ),
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    # The metadata queries have their own pool, so that they never take the
+    # connections kept alive with the data servers
+    session.mount(
+        ODE_URL + "/",
+        HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=ODE_POOL_SIZE,
+            max_retries=adapter.max_retries,
+        ),
+    )
+    return session
+
 
 class NoProductFoundException(Exception):
     """No product found"""
@@ -61,17 +162,21 @@ class PlanetaryFetchLib:
             *args: Additional arguments (not used).
             **kwargs: Keyword arguments that control the behavior of the library.
                 level (str): The logging level (default: "INFO").
-                max_workers (int): The maximum number of worker threads (default: 10).
+                max_workers (int): The maximum number of worker threads, clamped between 1 and 64, or -1 to tune it from the throughput.
                 disable_tqdm (bool) : Disable the progress bar
         """
         PlanetaryFetchLib._parse_level(kwargs["level"])
-        self.__max_workers = kwargs["max_workers"]
+        self.__max_workers = (
+            AUTO_MAX_WORKERS
+            if int(kwargs["max_workers"]) == AUTO_MAX_WORKERS
+            else max(1, min(int(kwargs["max_workers"]), MAX_WORKERS_LIMIT))
+        )
         self.__disable_tqdm = kwargs["disable_tqdm"]
         self.__directory = directory
         logger.info(
             f"""Starting with:
         - level = {kwargs["level"]}
-        - max workers = {kwargs["max_workers"]}
+        - max workers = {self.__max_workers}
         - output directory = {directory}
         - disable_tqdm = {kwargs["disable_tqdm"]}
         """
@@ -86,23 +191,13 @@ class PlanetaryFetchLib:
             level (str): level name
         """
         logger_main = logging.getLogger(__name_soft__)
-        if level == "INFO":
-            logger_main.setLevel(logging.INFO)
-        elif level == "DEBUG":
-            logger_main.setLevel(logging.DEBUG)
-        elif level == "WARNING":
-            logger_main.setLevel(logging.WARNING)
-        elif level == "ERROR":
-            logger_main.setLevel(logging.ERROR)
-        elif level == "CRITICAL":
-            logger_main.setLevel(logging.CRITICAL)
-        elif level == "TRACE":
-            logger_main.setLevel(logging.TRACE)  # type: ignore # pylint: disable=no-member
-        else:
+        level_num = _LEVELS.get(level)
+        if level_num is None:
             logger_main.warning(
                 "Unknown level name : %s - setting level to INFO", level
             )
-            logger_main.setLevel(logging.INFO)
+            level_num = logging.INFO
+        logger_main.setLevel(level_num)
 
     @property
     def max_workers(self) -> int:
@@ -131,6 +226,22 @@ class PlanetaryFetchLib:
         """
         return self.__directory
 
+    @staticmethod
+    def _product_key(product: Dict) -> str:
+        """Key identifying a product in the metadata.
+
+        Args:
+            product (Dict): metadata of the product
+
+        Returns:
+            str: the PDS ID of the product or, when it has none, its JSON
+            representation
+        """
+        pds_id = product.get("pdsid") or product.get("PDSID")
+        if pds_id is None:
+            return json.dumps(product, sort_keys=True)
+        return pds_id
+
     def _save_dict(self, metadata: List):
         """Save a dictionary to a file.
 
@@ -140,20 +251,71 @@ class PlanetaryFetchLib:
         file_path = os.path.join(self.directory, "my_dict.json")
 
         if os.path.exists(file_path):
-            with open(file_path, "r") as infile:
+            with open(file_path, "rb") as infile:
                 # Load the existing metadata from the file
-                existing_metadata = json.load(infile)
+                content = infile.read()
+            existing_metadata = (
+                json.loads(content)
+                if orjson is None
+                else orjson.loads(content)
+            )
 
-            # Merge the existing metadata with the new metadata
+            # Merge the existing metadata with the new metadata, the products
+            # being identified by their PDS ID
+            metadata_by_id = {
+                PlanetaryFetchLib._product_key(item): item
+                for item in existing_metadata
+            }
             for item in metadata:
-                if item not in existing_metadata:
-                    existing_metadata.append(item)
+                metadata_by_id.setdefault(
+                    PlanetaryFetchLib._product_key(item), item
+                )
 
-            metadata = existing_metadata
+            metadata = list(metadata_by_id.values())
+
+        # Write to a temporary file renamed once synced, so that a crash
+        # while writing never destroys the metadata of the previous runs
+        tmp_file_path = file_path + ".tmp"
+        if orjson is None:
+            with open(tmp_file_path, "w") as outfile:
+                # Write the merged metadata to the file in JSON format
+                json.dump(metadata, outfile, indent=2)
+                outfile.write("\n")
+                outfile.flush()
+                os.fsync(outfile.fileno())
+        else:
+            with open(tmp_file_path, "wb") as outfile:
+                # Write the merged metadata to the file in JSON format
+                outfile.write(
+                    orjson.dumps(
+                        metadata,
+                        option=orjson.OPT_INDENT_2 | orjson.OPT_APPEND_NEWLINE,
+                    )
+                )
+                outfile.flush()
+                os.fsync(outfile.fileno())
+        os.replace(tmp_file_path, file_path)
+
+    @staticmethod
+    def _open_connection(session: requests.Session, url: str):
+        """Send a HEAD request, so that the connection to the server of a URL
+        is kept alive in the pool of the session.
+
+        A failure is only logged: the download of the file reports it.
 
-        with open(file_path, "w") as outfile:
-            # Write the merged metadata to the file in JSON format
-            json.dump(metadata, outfile, indent=5)
+        Args:
+            session (requests.Session): HTTP session of the downloads
+            url (str): URL of a file to download
+        """
+        try:
+            session.head(
+                url,
+                headers=DOWNLOAD_HEADERS,
+                allow_redirects=True,
+                timeout=DOWNLOAD_TIMEOUT,
+            ).close()
+        except Exception as err:  # pylint: disable=broad-except
+            logger.debug(f"\tCannot open the connection to {url} : {err}")
 
     def run(self, ids: str):
         """Download PDS files for a given set of PDS IDs.
@@ -161,20 +323,32 @@ class PlanetaryFetchLib:
         Args:
             ids (str): IDs to download (* is allowed).
         """
-        pds_request = PdsRequest(ids, disable_tqdm=self.disable_tqdm)
-        query = pds_request.query()
-        try:
-            metadata, urls = pds_request.parse_response(query)
-            files = Files(
-                urls,
-                self.max_workers,
-                self.directory,
-                disable_tqdm=self.disable_tqdm,
-            )
-            self._save_dict(metadata)
-            files.download()
-        except NoProductFoundException:
-            logger.info("No product found")
+        # The same connection pool is used for the query and the downloads
+        with closing(create_session(self.max_workers)) as session:
+            pds_request = PdsRequest(ids, session=session)
+            query = pds_request.query()
+            try:
+                metadata, urls = pds_request.parse_response(query)
+                files = Files(
+                    urls,
+                    self.max_workers,
+                    self.directory,
+                    disable_tqdm=self.disable_tqdm,
+                    session=session,
+                )
+                if urls:
+                    # Open the connection to the data server while the
+                    # metadata is saved, without waiting for it before the
+                    # downloads
+                    threading.Thread(
+                        target=PlanetaryFetchLib._open_connection,
+                        args=(session, urls[0]),
+                        daemon=True,
+                    ).start()
+                self._save_dict(metadata)
+                files.download()
+            except NoProductFoundException:
+                logger.info("No product found")
 
 
 class PdsRequest:
@@ -197,20 +371,42 @@ class PdsRequest:
     """
 
     ODE_REQUEST_TPL = Template(
-        "https://oderest.rsl.wustl.edu/live2/default.aspx?query=product&results=copmf&output=json&pdsid=$pdsid"
+        ODE_URL
+        + "/live2/default.aspx?query=product&results=copmf&output=json&pdsid=$pdsid"
     )
 
-    def __init__(self, pds_id: str, **kwargs):
+    # Extensions (lower case) of the product files to download
+    FILE_EXTENSIONS = (".lbl", ".img")
+
+    def __init__(
+        self,
+        pds_id: str,
+        session: Optional[requests.Session] = None,
+        **kwargs,
+    ):
         self.pds_id = pds_id
         self.req = PdsRequest.ODE_REQUEST_TPL.substitute(pdsid=self.pds_id)
-        self.disable_tqdm = (
-            kwargs["disable_tqdm"] if "disable_tqdm" in kwargs else False
-        )
+        self.session = session
+        # the URL extraction has no progress bar anymore, the option is only
+        # accepted for the existing callers
+        if kwargs.pop("disable_tqdm", None) is not None:
+            warnings.warn(
+                "the disable_tqdm argument of PdsRequest has no effect",
+                DeprecationWarning,
+                stacklevel=2,
+            )
 
     def query(self):
         """Sends a GET request to the PDS API and returns the JSON response."""
-        response = requests.get(self.req)
-        return response.json()
+        if self.session is None:
+            response = requests.get(self.req, timeout=QUERY_TIMEOUT)
+        else:
+            response = self.session.get(self.req, timeout=QUERY_TIMEOUT)
+        response.raise_for_status()
+        if orjson is None:
+            return response.json()
+        # parse the bytes directly, without decoding them to text first
+        return orjson.loads(response.content)
 
     def parse_response(self, rjson):
         """Extracts the metadata and file URLs from the JSON response.
@@ -223,28 +419,36 @@ class PdsRequest:
             - The metadata for each product (list of dicts).
             - The URLs for each file to download (list of strings).
         """
-        files = list()
-        metadata = list()
         if rjson["ODEResults"]["Products"] == "No Products Found":
             raise NoProductFoundException()
         products = rjson["ODEResults"]["Products"]["Product"]
         logger.info(f"{len(products)} products found")
-        for product in tqdm(
-            products, desc="Extracting URLs", disable=self.disable_tqdm
-        ):
-            metadata.append(product)
-            product_files = product["Product_files"]["Product_file"]
-            for product_file in product_files:
-                url = product_file["URL"]
-                if ".lbl" in url.lower() or ".img" in url.lower():
-                    files.append(url)
-        return metadata, files
-
-
-class Files:
+        urls = (
+            product_file["URL"]
+            for product in products
+            for product_file in product["Product_files"]["Product_file"]
+        )
+        files = [
+            url
+            for url in urls
+            if url.lower().endswith(PdsRequest.FILE_EXTENSIONS)
+        ]
+        logger.info(f"{len(files)} file URLs extracted")
+        # Products may share the same files, download each of them only once
+        files = list(dict.fromkeys(files))
+        logger.info(f"{len(files)} unique file URLs")
+        return products, files
+
+
+class Files:  # pylint: disable=too-many-instance-attributes
     """
     Downloads files from a list of URLs and saves them to a specified directory.
 
+    The downloads run on a pool of max_workers threads sharing one HTTP
+    session. The workers spend their time blocked on socket reads and disk
+    writes, which release the GIL, so the threads overlap the network latency
+    as well as an event loop would while keeping the blocking requests API.
+
     Args:
         urls (List[str]): A list of URLs to download.
         max_workers (int): The maximum number of worker threads to use for downloading files.
@@ -257,6 +461,11 @@ class Files:
 
     Methods:
         download(): Downloads all files from the URLs list and saves them to the output directory.
+        close(): Closes the HTTP session shared by the workers.
+
+    Keyword Args:
+        disable_tqdm (bool): Disable the progress bar.
+        session (requests.Session): HTTP session to reuse instead of creating one.
 
     """
 
@@ -274,6 +483,86 @@ class Files:
         self.__disable_tqdm = (
             kwargs["disable_tqdm"] if "disable_tqdm" in kwargs else False
         )
+        # a session given by the caller is closed by the caller
+        self.__owns_session = kwargs.get("session") is None
+        self._session: requests.Session = (
+            create_session(max_workers)
+            if self.__owns_session
+            else kwargs["session"]
+        )
+        # semaphore of each server, created by the first worker requesting it
+        self.__host_semaphores: Dict[str, threading.Semaphore] = dict()
+        self.__host_semaphores_lock = threading.Lock()
+        # concurrency tuned from the throughput when max_workers is auto, a
+        # limit above the cap of the servers would have no effect
+        self.__limiter: Optional[AdaptiveLimiter] = (
+            AdaptiveLimiter(
+                default_max_workers(),
+                min(
+                    AUTO_MAX_WORKERS_CEILING,
+                    MAX_CONNECTIONS_PER_HOST
+                    * len({urlsplit(url).netloc for url in urls}),
+                ),
+            )
+            if max_workers == AUTO_MAX_WORKERS
+            else None
+        )
+        # size of the files on disk, by path, listed by _url_to_download
+        self.__local_sizes: Dict[str, int] = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def _interleave_by_host(urls: List[str]) -> List[str]:
+        """Reorder the URLs so that consecutive URLs target different servers.
+
+        The workers then spread over the servers instead of all waiting for
+        the same one.
+
+        Args:
+            urls (List[str]): URLs to reorder
+
+        Returns:
+            List[str]: the URLs taken in turn from each server
+        """
+        urls_by_host: Dict[str, List[str]] = defaultdict(list)
+        for url in urls:
+            urls_by_host[urlsplit(url).netloc].append(url)
+        return [
+            url
+            for urls_of_turn in zip_longest(*urls_by_host.values())
+            for url in urls_of_turn
+            if url is not None
+        ]
+
+    @staticmethod
+    def _preallocate(fd: int, size: int):
+        """Reserve the disk space of a file before writing it.
+
+        Allocating the whole file at once avoids the fragmentation of large
+        .img files written by 1 MiB chunks. Nothing is done when the size is
+        unknown or when the platform does not support it.
+
+        Args:
+            fd (int): file descriptor
+            size (int): size of the file in bytes
+        """
+        if size <= 0 or not hasattr(os, "posix_fallocate"):
+            return
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError as err:
+            # some file systems do not support it
+            logger.debug(f"\tCannot preallocate {size} bytes : {err}")
+
+    def close(self):
+        """Closes the HTTP session and its pooled connections, unless the session has been given by the caller."""
+        if self.__owns_session:
+            self._session.close()
 
     @property
     def urls(self) -> List[str]:
@@ -303,221 +592,294 @@ class Files:
         """
         return self.__file_organizer
 
-    def _download_url(self, url):
-        logger.debug(f"Downloading {url} ...")
-        response = requests.get(url)
-        filename = url.split("/")[-1]
-        self.file_organizer.filename = filename
-        filepath: str = os.path.join(self.file_organizer.organize(), filename)
-        try:
-            if os.path.exists(filepath):
-                logger.debug(
-                    f"\t{filename} is already complete, skip the download"
-                )
-            else:
-                with open(filepath, "wb") as file:
-                    file.write(response.content)
-                logger.debug(f"\t{filename} downloaded")
-            return
-        except NotImplementedError as err:
-            logger.warning(f"\tSkip the download of {url} : {err}")
-            return
+    def _remote_size(self, url: str) -> int:
+        """Size of a file on the server, from a HEAD request.
 
-    def _url_to_download(self) -> List[str]:
-        """URL to download based on the current URL already downloaded
+        Args:
+            url (str): URL of the file
 
         Returns:
-            List[str]: List of URL to download
+            int: the Content-Length of the file or -1 when it is not sent,
+            when the server refuses the HEAD request or cannot be reached
         """
-        list_to_download = list()
-        for url in self.urls:
-            filename: str = url.split("/")[-1]
-            self.file_organizer.filename = filename
-            try:
-                filepath: str = os.path.join(
-                    self.file_organizer.organize(), filename
-                )
-                if os.path.exists(filepath):
-                    logger.info(
-                        f"\t{filename} is already downloaded, skip the download"
-                    )
-                else:
-                    list_to_download.append(url)
+        try:
+            with self._session.head(
+                url,
+                headers=DOWNLOAD_HEADERS,
+                allow_redirects=True,
+                timeout=DOWNLOAD_TIMEOUT,
+            ) as response:
+                # the Content-Length of an error page is not the size of the
+                # file
+                if not response.ok:
+                    return -1
+                return int(response.headers.get("Content-Length", -1))
+        except requests.RequestException as err:
+            logger.debug(f"\tCannot get the size of {url} : {err}")
+            return -1
 
-            except NotImplementedError as err:
-                logger.warning(f"\tSkip the download of {url} : {err}")
+    @staticmethod
+    def _sync(file: BinaryIO):
+        """Flush the written data of a file to the disk.
 
-        logger.info(f"{len(list_to_download)} file(s) to download")
-        return list_to_download
+        Flushing large files regularly keeps the amount of dirty pages low,
+        so that the kernel does not stall all the writers at once when it
+        reaches its write-back threshold.
 
-    def download(self):
-        """
-        Downloads all files from the URLs list and saves them to the output directory.
+        Args:
+            file (BinaryIO): file opened for writing
         """
-        completed_count = 0
-
-        # Get the URLs to download based on the current URLs already downloaded
-        list_to_download: List[str] = self._url_to_download()
-
-        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            completed_count = 0
-            futures = []
-            for url in list_to_download:
-                future = executor.submit(self._download_url, url)
-                future.add_done_callback(
-                    lambda future, count=[completed_count]: count.__setitem__(
-                        0, count[0] + 1
-                    )
-                )
-                futures.append(future)
-
-            # Afficher une barre de progression
-            with tqdm(
-                total=len(list_to_download),
-                desc="Downloading file(s)",
-                disable=self.disable_tqdm,
-            ) as pbar:
-                while len(futures) > 0:
-                    for future in futures.copy():
-                        if future.done():
-                            futures.remove(future)
-                            pbar.update(1)
-
-                            # Mettre à jour le nombre de téléchargements terminés
-                            completed_count = completed_count + 1
-
-            # Afficher le nombre total de fichiers téléchargés
-            logger.info(
-                f"Total number of downloaded file(s) : {completed_count}"
-            )
-
+        file.flush()
+        if hasattr(os, "fdatasync"):
+            os.fdatasync(file.fileno())
+        else:
+            os.fsync(file.fileno())
 
-class FileOrganizer:
-    """
-    A class used to organize downloaded files into a directory structure based on file types.
-
-    Parameters
-    ----------
-    output_dir : str
-        The path to the directory where downloaded files should be stored.
-
-    Methods
-    -------
-    organize()
-        Organizes the downloaded file by moving it to the appropriate subdirectory based on its file type.
-
-    Attributes
-    ----------
-    filename : str
-        The name of the file to be organized.
-    """
+    @staticmethod
+    def _write_response(
+        response: requests.Response, filepath: str, offset: int = 0
+    ) -> int:
+        """Streams the body of a response to a file.
 
-    def __init__(self, base_directory: str):
-        """Initialize the FileOrganizer.
+        The body is written to a temporary file renamed once complete, so that
+        an interrupted download never leaves a truncated file under the final
+        name. When the download fails, the temporary file keeps the bytes
+        received so that the next run can resume it.
 
         Args:
-            base_directory (str): str
-        """
-        self.base_directory = base_directory
-        self.__filename = None
-
-    @property
-    def filename(self) -> str:
-        """Returns filename.
+            response (requests.Response): streamed response
+            filepath (str): path of the file to write
+            offset (int): position in the temporary file where the body
+            starts, 0 to write the whole file
 
         Returns:
-            str: filename
+            int: size of the written file
         """
-        return self.__filename
-
-    @filename.setter
-    def filename(self, value: str):
-        """Set filename
+        tmp_filepath = filepath + PART_SUFFIX
+        try:
+            with open(tmp_filepath, "r+b" if offset else "wb") as file:
+                file.seek(offset)
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(
+                        file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL
+                    )
+                Files._preallocate(
+                    file.fileno(),
+                    offset + int(response.headers.get("Content-Length", 0)),
+                )
+                try:
+                    # chunks larger than the buffer are written straight to
+                    # the file by BufferedWriter, which also retries the short
+                    # writes
+                    write = file.write
+                    written_since_sync = 0
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        # filter out keep-alive empty chunks
+                        if chunk:
+                            written_since_sync += write(chunk)
+                            if written_since_sync >= SYNC_SIZE:
+                                Files._sync(file)
+                                written_since_sync = 0
+                finally:
+                    # remove the preallocated space not written, so that the
+                    # file only contains the bytes received
+                    size = file.tell()
+                    file.truncate(size)
+                if size >= SYNC_SIZE and hasattr(os, "posix_fadvise"):
+                    # the file will not be read again, drop it from the
+                    # page cache once on disk
+                    Files._sync(file)
+                    os.posix_fadvise(
+                        file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED
+                    )
+        except BaseException:
+            if (
+                os.path.exists(tmp_filepath)
+                and os.path.getsize(tmp_filepath) == 0
+            ):
+                os.unlink(tmp_filepath)
+            raise
+        os.replace(tmp_filepath, filepath)
+        return size
+
+    def _host_semaphore(self, url: str) -> threading.Semaphore:
+        """Semaphore limiting the concurrent requests to the server of a URL.
 
         Args:
-            value (str): value
+            url (str): URL to download
+
+        Returns:
+            threading.Semaphore: the semaphore shared by the URLs of the server
         """
-        self.__filename = value
+        host = urlsplit(url).netloc
+        # the workers must not create two semaphores for the same server
+        with self.__host_semaphores_lock:
+            if host not in self.__host_semaphores:
+                self.__host_semaphores[host] = threading.Semaphore(
+                    MAX_CONNECTIONS_PER_HOST
+                )
+            return self.__host_semaphores[host]
 
-    def _build_directory_path(self, obs_type: str) -> str:
-        """Define the directory based on the observation type and the filename
+    def _download_url(self, url) -> bool:
+        """Downloads a file unless it is already complete on disk.
 
         Args:
-            obs_type (str): _description_
-
-        Raises:
-            NotImplementedError: Not implemented use case
+            url (str): URL of the file to download
 
         Returns:
-            str: the directory
+            bool: True when the file has been downloaded otherwise False
         """
-        if self.filename.lower().startswith(f"{obs_type}0000"):
-            subdirectory = os.path.splitext(self.filename)[0][7:9]
-            subsubdirectory = os.path.splitext(self.filename)[0][7:11]
-            if fnmatch.fnmatch(self.filename.lower(), "*_if*_trr3.*"):
-                directory_path = os.path.join(
-                    self.base_directory,
-                    obs_type.upper() + subdirectory.upper(),
-                    obs_type.upper() + subsubdirectory.upper(),
-                    "DATA",
-                )
-            elif fnmatch.fnmatch(self.filename.lower(), "*_de*_ddr1.*"):
-                directory_path = os.path.join(
-                    self.base_directory,
-                    obs_type.upper() + subdirectory.upper(),
-                    obs_type.upper() + subsubdirectory.upper(),
-                    "DDR",
-                )
-            else:
-                raise NotImplementedError(
-                    f"{self.filename} does not match any case for storage"
-                )
-        elif self.filename.lower().startswith(f"{obs_type}000"):
-            subdirectory = os.path.splitext(self.filename)[0][6:9]
-            subsubdirectory = os.path.splitext(self.filename)[0][6:11]
-            if fnmatch.fnmatch(self.filename.lower(), "*_if*_trr3.*"):
-                directory_path = os.path.join(
-                    self.base_directory,
-                    obs_type.upper() + subdirectory.upper(),
-                    obs_type.upper() + subsubdirectory.upper(),
-                    "DATA",
+        logger.debug(f"Downloading {url} ...")
+        filename = url.split("/")[-1]
+        filepath: str = os.path.join(
+            self.file_organizer.destdir_for(filename), filename
+        )
+        # Limit the number of concurrent requests sent to the same server
+        host_semaphore = self._host_semaphore(url)
+        # Limit the number of concurrent downloads when it is tuned
+        limiter: ContextManager = (
+            self.__limiter if self.__limiter is not None else nullcontext()
+        )
+        try:
+            # a server slot is only taken once the download may start
+            with limiter, host_semaphore:
+                local_size = self.__local_sizes.get(filepath)
+                part_size = self.__local_sizes.get(filepath + PART_SUFFIX, 0)
+                remote_size = (
+                    self._remote_size(url)
+                    if local_size is not None or part_size > 0
+                    else -1
                 )
-            elif fnmatch.fnmatch(self.filename.lower(), "*_de*_ddr1.*"):
-                directory_path = os.path.join(
-                    self.base_directory,
-                    obs_type.upper() + subdirectory.upper(),
-                    obs_type.upper() + subsubdirectory.upper(),
-                    "DDR",
+                # When the server does not send the size, a non-empty file
+                # is considered as complete
+                if local_size is not None and (
+                    local_size == remote_size or remote_size < 0 < local_size
+                ):
+                    logger.info(
+                        f"\t{filename} is already downloaded, skip the download"
+                    )
+                    return False
+                # Resume the download interrupted during a previous run
+                headers = dict(DOWNLOAD_HEADERS)
+                if 0 < part_size < remote_size:
+                    headers["Range"] = f"bytes={part_size}-"
+                response = self._session.get(
+                    url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT
                 )
-            else:
-                raise NotImplementedError(
-                    f"{self.filename} does not match any case for storage"
+                # the server may ignore the range and send the whole file
+                offset = (
+                    part_size
+                    if "Range" in headers and response.status_code == 206
+                    else 0
                 )
-        else:
-            raise NotImplementedError(
-                f"{self.filename} does not match any case for storage"
-            )
+                if offset and not response.headers.get(
+                    "Content-Range", ""
+                ).startswith(f"bytes {part_size}-"):
+                    # another range than the one requested, download the
+                    # whole file
+                    response.close()
+                    offset = 0
+                    response = self._session.get(
+                        url,
+                        headers=DOWNLOAD_HEADERS,
+                        stream=True,
+                        timeout=DOWNLOAD_TIMEOUT,
+                    )
+                with response:
+                    response.raise_for_status()
+                    size = Files._write_response(response, filepath, offset)
+                    self.__local_sizes[filepath] = size
+                if self.__limiter is not None:
+                    self.__limiter.record(size - offset)
+            logger.debug(f"\t{filename} downloaded")
+            return True
+        except NotImplementedError as err:
+            logger.warning(f"\tSkip the download of {url} : {err}")
+            return False
 
-        logger.debug(f"\t {self.filename} -> {directory_path}")
-        return directory_path
+    def _url_to_download(self) -> List[str]:
+        """URL to download, the files that cannot be stored are skipped.
+
+        The files already on disk are kept: their size is checked by the
+        workers, so that truncated files from a previous run are downloaded
+        again and the interrupted downloads are resumed.
 
-    def organize(self) -> str:
-        """Create and return the path to the subdirectory where the file should be saved based on its extension.
+        The output directories are created here, once per distinct
+        directory, so that the workers do not need to create them. Each
+        directory is listed once to know the files already on disk, instead
+        of checking each file.
 
         Returns:
-            str: The path to the subdirectory where the file should be saved.
+            List[str]: List of URL to download
         """
-        directory: str
-        if self.filename.lower().startswith("frt"):
-            directory = self._build_directory_path("frt")
-        elif self.filename.lower().startswith("hrl"):
-            directory = self._build_directory_path("hrl")
-        elif self.filename.lower().startswith("hrs"):
-            directory = self._build_directory_path("hrs")
-        else:
-            raise NotImplementedError("Only FRT, HRL and HRS are implemented")
+        list_to_download = list()
+        directories = set()
+        for url in self.urls:
+            filename: str = url.split("/")[-1]
+            try:
+                directories.add(self.file_organizer.destdir_for(filename))
+                list_to_download.append(url)
+            except NotImplementedError as err:
+                logger.warning(f"\tSkip the download of {url} : {err}")
 
-        # Create the directory if it doesn't exist
-        os.makedirs(directory, exist_ok=True)
+        for directory in directories:
+            os.makedirs(directory, exist_ok=True)
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        self.__local_sizes[entry.path] = entry.stat().st_size
 
-        return directory
+        logger.info(
+            f"{len(list_to_download)} file(s) to download or to check on disk"
+        )
+        return list_to_download
+
+    def download(self) -> int:
+        """
+        Downloads all files from the URLs list and saves them to the output directory.
+
+        Returns:
+            int: number of downloaded files, the skipped and failed ones
+            not included
+        """
+        completed_count = 0
+
+        # Get the URLs to download based on the current URLs already downloaded
+        list_to_download: List[str] = self._url_to_download()
+
+        with ThreadPoolExecutor(
+            max_workers=worker_threads(self.max_workers)
+        ) as executor:
+            # URL of each future, used to report the failed downloads
+            futures = {
+                executor.submit(self._download_url, url): url
+                for url in Files._interleave_by_host(list_to_download)
+            }
+
+            try:
+                # Afficher une barre de progression
+                for future in tqdm(
+                    as_completed(futures),
+                    total=len(futures),
+                    desc="Downloading file(s)",
+                    disable=self.disable_tqdm,
+                ):
+                    try:
+                        is_downloaded = future.result()
+                    except Exception as err:  # pylint: disable=broad-except
+                        logger.warning(
+                            f"\tCannot download {futures[future]} : {err}"
+                        )
+                    else:
+                        # Mettre à jour le nombre de téléchargements terminés
+                        if is_downloaded:
+                            completed_count += 1
+            except BaseException:
+                # When interrupted (Ctrl+C), only wait for the running
+                # downloads instead of the whole queue
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+
+        # Afficher le nombre total de fichiers téléchargés
+        logger.info(f"Total number of downloaded file(s) : {completed_count}")
+        return completed_count
@@ -51,6 +51,10 @@ setuptools.setup(
     ],
     python_requires=">=3.10",
     install_requires=required,
+    extras_require={
+        # faster parsing and writing of the metadata
+        "orjson": ["orjson>=3.0"],
+    },
     entry_points={
         "console_scripts": [
             about["__name_soft__"]
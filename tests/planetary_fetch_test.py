@@ -1,13 +1,97 @@
 # -*- coding: utf-8 -*-
+import json
 import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
+import requests
 
 import planetary_fetch
+from planetary_fetch.concurrency import AdaptiveLimiter
+from planetary_fetch.file_organizer import FileOrganizer
+from planetary_fetch.planetary_fetch import Files
+from planetary_fetch.planetary_fetch import NoProductFoundException
+from planetary_fetch.planetary_fetch import PdsRequest
+from planetary_fetch.planetary_fetch import PlanetaryFetchLib
 
 logger = logging.getLogger(__name__)
 
 
+class FakeResponse:
+    """Streamed response without any content attribute"""
+
+    def __init__(self, chunks, status_code=200):
+        self.chunks = chunks
+        self.status_code = status_code
+        size = sum(len(chunk) for chunk in chunks if isinstance(chunk, bytes))
+        self.headers = {"Content-Length": str(size)}
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def close(self):
+        pass
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise IOError(f"HTTP {self.status_code}")
+
+    def iter_content(self, chunk_size):
+        for chunk in self.chunks:
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+
+class FakeSession:
+    """Session serving the same chunks for each URL, except the missing ones"""
+
+    def __init__(self, chunks, missing=(), head_status=200):
+        self.chunks = chunks
+        self.missing = missing
+        self.head_status = head_status
+        self.requested = list()
+
+    def _response(self, url):
+        return FakeResponse(self.chunks, 404 if url in self.missing else 200)
+
+    def get(self, url, headers=None, **kwargs):
+        assert kwargs["stream"]
+        assert headers["Accept-Encoding"] == "identity"
+        self.requested.append(url)
+        if "Range" in headers:
+            return self._range_response(int(headers["Range"][6:-1]))
+        return self._response(url)
+
+    def _range_response(self, start):
+        content = b"".join(self.chunks)
+        response = FakeResponse([content[start:]], 206)
+        response.headers["Content-Range"] = (
+            f"bytes {start}-{len(content) - 1}/{len(content)}"
+        )
+        return response
+
+    def head(self, url, **kwargs):
+        assert kwargs["headers"]["Accept-Encoding"] == "identity"
+        if self.head_status != 200:
+            return FakeResponse([b"error page"], self.head_status)
+        return self._response(url)
+
+    def close(self):
+        pass
+
+
 @pytest.fixture
 def setup():
     logger.info("----- Init the tests ------")
@@ -90,3 +174,479 @@ def test_color_formatter():
         None,
     )
     shell_formatter.format(record)
+
+
+def test_parse_response():
+    rjson = {
+        "ODEResults": {
+            "Products": {
+                "Product": [
+                    {
+                        "pdsid": "FRT00001234_07_IF166L_TRR3",
+                        "Product_files": {
+                            "Product_file": [
+                                {"URL": "http://host/frt00001234_07.lbl"},
+                                {"URL": "http://host/frt00001234_07.img"},
+                                {"URL": "http://host/frt00001234_07.jpg"},
+                            ]
+                        },
+                    },
+                    {
+                        "pdsid": "FRT00001234_07_DE166L_DDR1",
+                        "Product_files": {
+                            "Product_file": [
+                                {"URL": "http://host/frt00001234_07.lbl"},
+                                {"URL": "http://host/FRT00001234_DE.IMG"},
+                                {"URL": "http://host/FRT00001234_DE.Lbl"},
+                            ]
+                        },
+                    },
+                ]
+            }
+        }
+    }
+    pds_request = PdsRequest("FRT00001234*")
+    metadata, urls = pds_request.parse_response(rjson)
+    assert len(metadata) == 2
+    assert urls == [
+        "http://host/frt00001234_07.lbl",
+        "http://host/frt00001234_07.img",
+        "http://host/FRT00001234_DE.IMG",
+        "http://host/FRT00001234_DE.Lbl",
+    ]
+
+
+def test_pds_request_disable_tqdm_deprecated():
+    with pytest.warns(DeprecationWarning):
+        pds_request = PdsRequest("FRT00001234*", disable_tqdm=True)
+    assert not hasattr(pds_request, "disable_tqdm")
+
+
+def test_parse_response_no_product():
+    pds_request = PdsRequest("FRT00001234*")
+    with pytest.raises(NoProductFoundException):
+        pds_request.parse_response(
+            {"ODEResults": {"Products": "No Products Found"}}
+        )
+
+
+def test_download_url_streams_chunks(tmp_path):
+    url = "http://host/frt00001234_07_if166l_trr3.img"
+    session = FakeSession([b"abc", b"", b"def"])
+    files = Files([url], 1, str(tmp_path), session=session)
+    assert files._url_to_download() == [url]
+    assert files._download_url(url)
+    filepath = os.path.join(
+        str(tmp_path), "FRT12", "FRT1234", "DATA", url.split("/")[-1]
+    )
+    with open(filepath, "rb") as file:
+        assert file.read() == b"abcdef"
+    # the file is complete, it is not downloaded again
+    assert not files._download_url(url)
+    assert session.requested == [url]
+
+
+def test_download_url_head_refused(tmp_path):
+    url = "http://host/frt00001234_07_if166l_trr3.img"
+    session = FakeSession([b"abcdef"], head_status=405)
+    files = Files([url], 1, str(tmp_path), session=session)
+    files._url_to_download()
+    assert files._download_url(url)
+    files = Files([url], 1, str(tmp_path), session=session)
+    files._url_to_download()
+    # the size of the error page is not compared with the file on disk
+    assert not files._download_url(url)
+    assert session.requested == [url]
+
+
+def test_download_url_head_unreachable(tmp_path, monkeypatch):
+    url = "http://host/frt00001234_07_if166l_trr3.img"
+    session = FakeSession([b"abcdef"])
+    files = Files([url], 1, str(tmp_path), session=session)
+    files._url_to_download()
+    assert files._download_url(url)
+
+    def head(url, **kwargs):
+        raise requests.ConnectionError("network is unreachable")
+
+    monkeypatch.setattr(session, "head", head)
+    files = Files([url], 1, str(tmp_path), session=session)
+    files._url_to_download()
+    # a non-empty file is kept when its size cannot be checked
+    assert not files._download_url(url)
+    assert session.requested == [url]
+
+
+def test_download_url_interrupted(tmp_path):
+    url = "http://host/frt00001234_07_if166l_trr3.img"
+    session = FakeSession([b"abc", IOError("connection reset")])
+    files = Files([url], 1, str(tmp_path), session=session)
+    files._url_to_download()
+    with pytest.raises(IOError):
+        files._download_url(url)
+    directory = os.path.join(str(tmp_path), "FRT12", "FRT1234", "DATA")
+    # the bytes received are kept to resume the download
+    assert os.listdir(directory) == ["frt00001234_07_if166l_trr3.img.part"]
+    with open(os.path.join(directory, os.listdir(directory)[0]), "rb") as f:
+        assert f.read() == b"abc"
+
+
+@pytest.mark.skipif(
+    not hasattr(os, "posix_fallocate"), reason="no posix_fallocate"
+)
+def test_write_response_interrupted_after_preallocation(
+    tmp_path, monkeypatch
+):
+    preallocated = list()
+    posix_fallocate = os.posix_fallocate
+
+    def spy_posix_fallocate(fd, offset, size):
+        preallocated.append(size)
+        posix_fallocate(fd, offset, size)
+
+    monkeypatch.setattr(os, "posix_fallocate", spy_posix_fallocate)
+    response = FakeResponse([b"abc", IOError("connection reset")])
+    response.headers["Content-Length"] = str(1 << 20)
+    filepath = os.path.join(str(tmp_path), "frt00001234_07_if166l_trr3.img")
+    with pytest.raises(IOError):
+        Files._write_response(response, filepath)
+    assert preallocated == [1 << 20]
+    # the preallocated space not written is removed
+    assert os.listdir(str(tmp_path)) == ["frt00001234_07_if166l_trr3.img.part"]
+    with open(filepath + ".part", "rb") as f:
+        assert f.read() == b"abc"
+
+
+def test_download_url_resumed(tmp_path):
+    url = "http://host/frt00001234_07_if166l_trr3.img"
+    directory = os.path.join(str(tmp_path), "FRT12", "FRT1234", "DATA")
+    os.makedirs(directory)
+    filepath = os.path.join(directory, "frt00001234_07_if166l_trr3.img")
+    with open(filepath + ".part", "wb") as f:
+        f.write(b"abc")
+    files = Files([url], 1, str(tmp_path), session=FakeSession([b"abcdef"]))
+    files._url_to_download()
+    assert files._download_url(url)
+    assert not os.path.exists(filepath + ".part")
+    with open(filepath, "rb") as f:
+        assert f.read() == b"abcdef"
+
+
+def test_download_url_resumed_at_another_offset(tmp_path):
+    class WrongRangeSession(FakeSession):
+        """Session sending the content from its start with a 206"""
+
+        def _range_response(self, start):
+            return super()._range_response(0)
+
+    url = "http://host/frt00001234_07_if166l_trr3.img"
+    directory = os.path.join(str(tmp_path), "FRT12", "FRT1234", "DATA")
+    os.makedirs(directory)
+    filepath = os.path.join(directory, "frt00001234_07_if166l_trr3.img")
+    with open(filepath + ".part", "wb") as f:
+        f.write(b"abc")
+    session = WrongRangeSession([b"abcdef"])
+    files = Files([url], 1, str(tmp_path), session=session)
+    files._url_to_download()
+    assert files._download_url(url)
+    # the whole file is downloaded again
+    assert session.requested == [url, url]
+    with open(filepath, "rb") as f:
+        assert f.read() == b"abcdef"
+
+
+def test_download_continues_after_failure(tmp_path):
+    urls = [
+        f"http://host/frt00001234_07_if166l_trr3.{ext}"
+        for ext in ("lbl", "img", "tab")
+    ]
+    session = FakeSession([b"data"], missing=[urls[0]])
+    files = Files(urls, 2, str(tmp_path), session=session, disable_tqdm=True)
+    assert files.download() == 2
+    directory = os.path.join(str(tmp_path), "FRT12", "FRT1234", "DATA")
+    assert sorted(os.listdir(directory)) == [
+        "frt00001234_07_if166l_trr3.img",
+        "frt00001234_07_if166l_trr3.tab",
+    ]
+
+
+def test_download_limits_requests_per_host(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        planetary_fetch.planetary_fetch, "MAX_CONNECTIONS_PER_HOST", 2
+    )
+
+    class CountingSession(FakeSession):
+        """Session recording the peak of concurrent requests per server"""
+
+        def __init__(self):
+            super().__init__([b"data"])
+            self.lock = threading.Lock()
+            self.active = defaultdict(int)
+            self.peak = defaultdict(int)
+
+        def get(self, url, **kwargs):
+            host = url.split("/")[2]
+            with self.lock:
+                self.active[host] += 1
+                self.peak[host] = max(self.peak[host], self.active[host])
+            time.sleep(0.02)
+            with self.lock:
+                self.active[host] -= 1
+            return super().get(url, **kwargs)
+
+    urls = [
+        f"http://host{index % 2 + 1}/frt0000{index:04x}_07_if166l_trr3.img"
+        for index in range(16)
+    ]
+    session = CountingSession()
+    files = Files(urls, 8, str(tmp_path), session=session, disable_tqdm=True)
+    assert files.download() == 16
+    assert session.peak == {"host1": 2, "host2": 2}
+
+
+@pytest.fixture(params=["orjson", "json"])
+def json_library(request, monkeypatch):
+    """Runs a test with orjson, when installed, and with the json fallback"""
+    if request.param == "json":
+        monkeypatch.setattr(planetary_fetch.planetary_fetch, "orjson", None)
+    return request.param
+
+
+def test_query(json_library):
+    class JsonResponse(FakeResponse):
+        content = b'{"ODEResults": {"Products": "No Products Found"}}'
+
+        def json(self):
+            return json.loads(self.content)
+
+    class QuerySession(FakeSession):
+        def get(self, url, **kwargs):
+            self.requested.append(url)
+            return JsonResponse([])
+
+    session = QuerySession([])
+    pds_request = PdsRequest("FRT00001234*", session=session)
+    assert pds_request.query() == {
+        "ODEResults": {"Products": "No Products Found"}
+    }
+    assert session.requested == [pds_request.req]
+
+
+def test_download_interrupted_cancels_queued_downloads(tmp_path):
+    class InterruptedSession(FakeSession):
+        """Session interrupted (Ctrl+C) on its first request"""
+
+        def get(self, url, **kwargs):
+            if not self.requested:
+                self.requested.append(url)
+                raise KeyboardInterrupt()
+            time.sleep(0.05)
+            return super().get(url, **kwargs)
+
+    urls = [
+        f"http://host/frt0000{index:04x}_07_if166l_trr3.img"
+        for index in range(20)
+    ]
+    session = InterruptedSession([b"data"])
+    files = Files(urls, 1, str(tmp_path), session=session, disable_tqdm=True)
+    with pytest.raises(KeyboardInterrupt):
+        files.download()
+    # only the download running when interrupted is waited for
+    assert len(session.requested) <= 2
+
+
+def test_run_does_not_wait_for_the_connection(
+    tmp_path, monkeypatch, caplog
+):
+    url = "http://host/frt00001234_07_if166l_trr3.img"
+    released = threading.Event()
+    failed = threading.Event()
+
+    class SlowHeadSession(FakeSession):
+        """Session whose HEAD requests fail once released"""
+
+        def get(self, url, **kwargs):
+            if url.startswith(planetary_fetch.planetary_fetch.ODE_URL):
+                response = FakeResponse([])
+                response.json = lambda: rjson
+                response.content = json.dumps(rjson).encode()
+                return response
+            return super().get(url, **kwargs)
+
+        def head(self, url, **kwargs):
+            released.wait(5)
+            failed.set()
+            raise IOError("connection refused")
+
+    rjson = {
+        "ODEResults": {
+            "Products": {
+                "Product": [
+                    {
+                        "pdsid": "FRT00001234_07_IF166L_TRR3",
+                        "Product_files": {"Product_file": [{"URL": url}]},
+                    }
+                ]
+            }
+        }
+    }
+    session = SlowHeadSession([b"data"])
+    monkeypatch.setattr(
+        planetary_fetch.planetary_fetch,
+        "create_session",
+        lambda max_workers: session,
+    )
+    monkeypatch.setattr(logging.getLogger("planetary_fetch"), "propagate", True)
+    caplog.set_level(logging.DEBUG, logger="planetary_fetch.planetary_fetch")
+    lib = PlanetaryFetchLib(
+        str(tmp_path), level="DEBUG", max_workers=1, disable_tqdm=True
+    )
+    lib.run("FRT00001234*")
+    # the download has not waited for the HEAD request
+    assert session.requested == [url]
+    assert not failed.is_set()
+    released.set()
+    assert failed.wait(5)
+    for _ in range(100):
+        if "Cannot open the connection" in caplog.text:
+            break
+        time.sleep(0.01)
+    assert f"Cannot open the connection to {url}" in caplog.text
+
+
+def test_save_dict_merges_by_pds_id(tmp_path, json_library):
+    lib = PlanetaryFetchLib(
+        str(tmp_path), level="INFO", max_workers=1, disable_tqdm=True
+    )
+    lib._save_dict([{"pdsid": "A", "version": 1}, {"pdsid": "B"}])
+    lib._save_dict([{"pdsid": "A", "version": 2}, {"pdsid": "C"}])
+    with open(os.path.join(str(tmp_path), "my_dict.json")) as infile:
+        metadata = json.load(infile)
+    assert metadata == [
+        {"pdsid": "A", "version": 1},
+        {"pdsid": "B"},
+        {"pdsid": "C"},
+    ]
+
+
+def test_download_url_large_file(tmp_path):
+    url = "http://host/frt00001234_07_if166l_trr3.img"
+    chunks = [bytes([index]) * (1 << 20) for index in range(10)]
+    files = Files([url], 1, str(tmp_path), session=FakeSession(chunks))
+    files._url_to_download()
+    assert files._download_url(url)
+    filepath = os.path.join(
+        str(tmp_path), "FRT12", "FRT1234", "DATA", url.split("/")[-1]
+    )
+    with open(filepath, "rb") as file:
+        assert file.read() == b"".join(chunks)
+
+
+@pytest.mark.skipif(
+    not hasattr(os, "posix_fadvise"), reason="no posix_fadvise"
+)
+def test_write_response_syncs_large_file(tmp_path, monkeypatch):
+    synced_sizes = list()
+    sync = Files._sync
+    advices = list()
+    posix_fadvise = os.posix_fadvise
+
+    def spy_sync(file):
+        sync(file)
+        synced_sizes.append(file.tell())
+
+    def spy_posix_fadvise(fd, offset, length, advice):
+        advices.append(advice)
+        posix_fadvise(fd, offset, length, advice)
+
+    monkeypatch.setattr(Files, "_sync", staticmethod(spy_sync))
+    monkeypatch.setattr(os, "posix_fadvise", spy_posix_fadvise)
+    chunks = [bytes([index]) * (1 << 20) for index in range(10)]
+    filepath = os.path.join(str(tmp_path), "frt00001234_07_if166l_trr3.img")
+    assert Files._write_response(FakeResponse(chunks), filepath) == 10 << 20
+    # flushed after 8 MiB, then once complete before leaving the page cache
+    assert synced_sizes == [8 << 20, 10 << 20]
+    assert advices == [os.POSIX_FADV_SEQUENTIAL, os.POSIX_FADV_DONTNEED]
+
+
+def test_adaptive_limiter():
+    now = [0.0]
+    limiter = AdaptiveLimiter(
+        4, 8, window=1, step=2, clock=lambda: now[0], min_size=10
+    )
+    # the small downloads are ignored
+    now[0] += 1
+    limiter.record(1)
+    assert limiter.limit == 4
+    # the throughput increases: the limit keeps growing up to the maximum
+    for size in (100, 200, 300):
+        now[0] += 1
+        limiter.record(size)
+    assert limiter.limit == 8
+    # the throughput decreases: the direction is reversed
+    now[0] += 1
+    limiter.record(10)
+    assert limiter.limit == 6
+    with limiter:
+        pass
+
+
+def test_adaptive_limiter_blocks_above_limit():
+    limiter = AdaptiveLimiter(3, 8)
+    lock = threading.Lock()
+    active = [0]
+    peak = [0]
+
+    def download(_):
+        with limiter:
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.02)
+            with lock:
+                active[0] -= 1
+
+    with ThreadPoolExecutor(max_workers=12) as executor:
+        list(executor.map(download, range(24)))
+    assert peak[0] == 3
+
+
+@pytest.mark.parametrize(
+    "filename,directory",
+    [
+        ("frt00001234_07_if166l_trr3.img", ["FRT12", "FRT1234", "DATA"]),
+        ("FRT00001234_07_IF166L_TRR3.LBL", ["FRT12", "FRT1234", "DATA"]),
+        ("hrl0000ca5c_07_de183j_ddr1.lbl", ["HRLCA", "HRLCA5C", "DDR"]),
+        ("hrs000abcde_07_if183j_trr3.img", ["HRSABC", "HRSABCDE", "DATA"]),
+    ],
+)
+def test_file_organizer(tmp_path, filename, directory):
+    file_organizer = FileOrganizer(str(tmp_path))
+    expected = os.path.join(str(tmp_path), *directory)
+    assert file_organizer.organize(filename) == expected
+    assert os.path.isdir(expected)
+
+
+@pytest.mark.parametrize(
+    "filename", ["frt00001234_07_xx166l_trr3.img", "msp00001234_07.img"]
+)
+def test_file_organizer_not_implemented(tmp_path, filename):
+    with pytest.raises(NotImplementedError):
+        FileOrganizer(str(tmp_path)).destdir_for(filename)
+
+
+def test_file_organizer_shared_by_threads(tmp_path):
+    file_organizer = FileOrganizer(str(tmp_path))
+    filenames = [
+        f"{obs_type}0000{index:04x}_07_if166l_trr3.img"
+        for obs_type in ("frt", "hrl", "hrs")
+        for index in range(100)
+    ]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        directories = list(executor.map(file_organizer.organize, filenames))
+    for filename, directory in zip(filenames, directories):
+        prefix = filename[:3].upper()
+        stem = filename[7:11].upper()
+        assert directory == os.path.join(
+            str(tmp_path), prefix + stem[:2], prefix + stem, "DATA"
+        )